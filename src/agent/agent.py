@@ -2,6 +2,9 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import concurrent.futures
+import heapq
+import itertools
 import json
 import os
 import platform
@@ -9,7 +12,7 @@ import socket
 import ssl
 import time
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 try:
     import psutil 
@@ -19,14 +22,18 @@ except Exception:
 from src.shared.protocol import (
     TCP_SERVER_PORT,
     UDP_DISCOVERY_PORT,
+    DISCOVERY_MAGIC,
     DEFAULT_AUTH_TOKEN,
+    HEARTBEAT_PREFIX,
     dumps,
+    dumps_value,
     loads,
     new_client_id,
     PROTOCOL_VERSION,
+    LineProtocol,
+    install_uvloop,
 )
 
-DISCOVERY_MAGIC = b"DISCOVER_PC_MONITOR"
 HEARTBEAT_INTERVAL_S = 2.0
 METRICS_INTERVAL_S = 2.0
 
@@ -44,7 +51,7 @@ class AgentConfig:
     use_tls: bool
 
 
-def get_basic_sysinfo() -> Dict[str, Any]:
+def _build_sysinfo() -> Dict[str, Any]:
     """
     Trả về thông tin hệ điều hành CHUẨN.
     Windows 11 được xác định theo OS Build >= 22000
@@ -80,12 +87,38 @@ def get_basic_sysinfo() -> Dict[str, Any]:
     }
 
 
+# Sysinfo không đổi trong suốt vòng đời agent -> tính 1 lần lúc import.
+_CACHED_SYSINFO = _build_sysinfo()
+
+
+def get_basic_sysinfo() -> Dict[str, Any]:
+    return _CACHED_SYSINFO
+
+
+# psutil giữ mốc cpu_percent(interval=None) theo từng thread -> mọi lần thu thập psutil chạy trên
+# một worker thread cố định (prime trên chính thread đó), không dùng default executor.
+_PSUTIL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="psutil")
+
+
+def _prime_cpu_percent() -> None:
+    if psutil is None:
+        return
+    try:
+        psutil.cpu_percent(interval=None)
+    except Exception:
+        pass
+
+
+_PSUTIL_EXECUTOR.submit(_prime_cpu_percent)
+
+
 def get_metrics() -> Dict[str, Any]:
     if psutil is None:
         return {"cpu_percent": None, "mem_percent": None, "disk_percent": None}
 
     try:
-        cpu = psutil.cpu_percent(interval=0.2)
+        # interval=None: không sleep, trả về %CPU kể từ lần gọi trước trên cùng thread (_PSUTIL_EXECUTOR).
+        cpu = psutil.cpu_percent(interval=None)
         mem = psutil.virtual_memory().percent
         disk = psutil.disk_usage(os.path.abspath(os.sep)).percent
         return {"cpu_percent": cpu, "mem_percent": mem, "disk_percent": disk}
@@ -104,8 +137,8 @@ def get_processes_top(n: int = 30) -> Any:
                 procs.append(p.info)
             except Exception:
                 pass
-        procs.sort(key=lambda x: (x.get("cpu_percent") or 0), reverse=True)
-        return procs[:n]
+        # Chỉ cần top-n -> heap kích thước n thay vì sort toàn bộ danh sách.
+        return heapq.nlargest(n, procs, key=lambda x: (x.get("cpu_percent") or 0))
     except Exception as e:
         return {"error": f"failed to list processes: {e}"}
 
@@ -114,49 +147,56 @@ def get_net_connections_summary(limit: int = 50) -> Any:
     if psutil is None:
         return {"error": "psutil not installed"}
 
-    conns = []
     try:
-        for c in psutil.net_connections(kind="inet"):
-            try:
-                laddr = f"{c.laddr.ip}:{c.laddr.port}" if c.laddr else ""
-                raddr = f"{c.raddr.ip}:{c.raddr.port}" if c.raddr else ""
-                conns.append(
-                    {
-                        "fd": c.fd,
-                        "type": str(c.type),
-                        "status": c.status,
-                        "laddr": laddr,
-                        "raddr": raddr,
-                        "pid": c.pid,
-                    }
-                )
-                if len(conns) >= limit:
-                    break
-            except Exception:
-                pass
-        return conns
+        return [
+            {
+                "fd": c.fd,
+                "type": str(c.type),
+                "status": c.status,
+                "laddr": f"{c.laddr.ip}:{c.laddr.port}" if c.laddr else "",
+                "raddr": f"{c.raddr.ip}:{c.raddr.port}" if c.raddr else "",
+                "pid": c.pid,
+            }
+            for c in itertools.islice(psutil.net_connections(kind="inet"), limit)
+        ]
     except Exception as e:
         return {"error": f"failed to list connections: {e}"}
 
 
+class _DiscoveryClient(asyncio.DatagramProtocol):
+    def __init__(self, reply: asyncio.Future) -> None:
+        self.reply = reply
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if not self.reply.done():
+            self.reply.set_result((data, addr))
+
+    def error_received(self, exc: Exception) -> None:
+        if not self.reply.done():
+            self.reply.set_exception(exc)
+
+
 async def discover_server(timeout: float = 2.0) -> Optional[Tuple[str, int]]:
-    """UDP broadcast discovery: find server on LAN."""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.settimeout(timeout)
+    """UDP broadcast discovery: find server on LAN (không block event loop khi chờ reply)."""
+    loop = asyncio.get_running_loop()
+    reply: asyncio.Future = loop.create_future()
+    transport = None
 
     try:
-        sock.sendto(DISCOVERY_MAGIC, ("255.255.255.255", UDP_DISCOVERY_PORT))
-        data, addr = sock.recvfrom(2048)
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DiscoveryClient(reply),
+            family=socket.AF_INET,
+            allow_broadcast=True,
+        )
+        transport.sendto(DISCOVERY_MAGIC, ("255.255.255.255", UDP_DISCOVERY_PORT))
+        data, addr = await asyncio.wait_for(reply, timeout)
         payload = json.loads(data.decode("utf-8"))
         return addr[0], int(payload.get("tcp_port", TCP_SERVER_PORT))
     except Exception:
         return None
     finally:
-        try:
-            sock.close()
-        except Exception:
-            pass
+        if transport is not None:
+            transport.close()
 
 
 def build_ssl_context() -> ssl.SSLContext:
@@ -181,131 +221,174 @@ def _pack_auth(cfg: AgentConfig) -> bytes:
     )
 
 
+# Heartbeat chỉ khác nhau ở "t" -> dựng sẵn phần cố định, mỗi lần chỉ format timestamp.
+_HB_SUFFIX = b"}}\n"
+
+
 def _pack_heartbeat() -> bytes:
-    return dumps({"v": PROTOCOL_VERSION, "type": "heartbeat", "payload": {"t": time.time()}})
+    return b"%s%r%s" % (HEARTBEAT_PREFIX, time.time(), _HB_SUFFIX)
 
 
 def _pack_metrics() -> bytes:
     return dumps({"v": PROTOCOL_VERSION, "type": "metrics", "payload": get_metrics()})
 
 
+_RESP_PREFIX = b'{"v":' + json.dumps(PROTOCOL_VERSION).encode("utf-8") + b',"type":"response","request_id":'
+
+
 def _pack_response(request_id: Any, payload: Dict[str, Any]) -> bytes:
-    return dumps(
-        {
-            "v": PROTOCOL_VERSION,
-            "type": "response",
-            "request_id": request_id,
-            "payload": payload,
-        }
+    return b"".join(
+        (
+            _RESP_PREFIX,
+            dumps_value(request_id),
+            b',"payload":',
+            dumps_value(payload),
+            b"}\n",
+        )
     )
 
 
-async def _authenticate(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, cfg: AgentConfig) -> None:
-    writer.write(_pack_auth(cfg))
-    await writer.drain()
+def _handle_request(msg: Dict[str, Any]) -> bytes:
+    rid = msg.get("request_id")
+    req_type = (msg.get("payload") or {}).get("req_type")
 
-    line = await reader.readline()
-    if not line:
-        raise RuntimeError("server closed during auth")
+    if req_type == "sysinfo":
+        payload = {"sysinfo": get_basic_sysinfo(), "metrics": get_metrics()}
+    elif req_type == "processes":
+        payload = {"processes": get_processes_top(30)}
+    elif req_type == "netstat":
+        payload = {"connections": get_net_connections_summary(50)}
+    else:
+        payload = {"error": f"unknown req_type: {req_type}"}
 
-    resp = loads(line)
-    if resp.get("type") != "auth_ok":
-        raise RuntimeError(f"auth failed: {resp}")
+    return _pack_response(rid, payload)
 
 
-async def _send_loop(writer: asyncio.StreamWriter, stop: asyncio.Event) -> None:
+class AgentProtocol(LineProtocol):
     """
-    Gửi heartbeat + metrics định kỳ.
-    Tách interval vẫn đồng bộ 2s; nếu bạn muốn khác nhau, có thể tách 2 task.
+    Kết nối agent -> server: gửi auth khi connect, sau đó trả lời request.
+    Request được xử lý trong thread pool (psutil có thể block) rồi ghi response về loop.
     """
-    next_hb = time.monotonic()
-    next_metrics = time.monotonic()
 
-    while not stop.is_set():
-        now = time.monotonic()
-        out = b""
-
-        if now >= next_hb:
-            out += _pack_heartbeat()
-            next_hb = now + HEARTBEAT_INTERVAL_S
-
-        if now >= next_metrics:
-            out += _pack_metrics()
-            next_metrics = now + METRICS_INTERVAL_S
+    def __init__(self, cfg: AgentConfig) -> None:
+        super().__init__()
+        loop = asyncio.get_running_loop()
+        self.cfg = cfg
+        self.authenticated: asyncio.Future = loop.create_future()
+        self.closed: asyncio.Future = loop.create_future()
+        self._tasks: Set[asyncio.Task] = set()
 
-        if out:
-            writer.write(out)
-            await writer.drain()
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        super().connection_made(transport)
+        self.write(_pack_auth(self.cfg))
 
-        await asyncio.sleep(0.1)
-
-
-async def _recv_loop(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, stop: asyncio.Event) -> None:
-    while not stop.is_set():
-        line = await reader.readline()
-        if not line:
-            break
+    def handle_message(self, line: bytes) -> None:
+        if not self.authenticated.done():
+            try:
+                resp = loads(line)
+            except Exception as exc:
+                self.authenticated.set_exception(RuntimeError(f"auth failed: {exc}"))
+                self.transport.close()
+                return
+            if resp.get("type") != "auth_ok":
+                self.authenticated.set_exception(RuntimeError(f"auth failed: {resp}"))
+                self.transport.close()
+                return
+            self.authenticated.set_result(None)
+            return
 
         try:
             msg = loads(line)
         except Exception:
-            continue
+            return
 
         if msg.get("type") != "request":
-            continue
+            return
 
-        rid = msg.get("request_id")
-        req_type = (msg.get("payload") or {}).get("req_type")
+        task = asyncio.ensure_future(self._respond(msg))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-        if req_type == "sysinfo":
-            payload = {"sysinfo": get_basic_sysinfo(), "metrics": get_metrics()}
-        elif req_type == "processes":
-            payload = {"processes": get_processes_top(30)}
-        elif req_type == "netstat":
-            payload = {"connections": get_net_connections_summary(50)}
-        else:
-            payload = {"error": f"unknown req_type: {req_type}"}
+    async def _respond(self, msg: Dict[str, Any]) -> None:
+        frame = await asyncio.get_running_loop().run_in_executor(_PSUTIL_EXECUTOR, _handle_request, msg)
+        if not self.transport.is_closing():
+            self.write(frame)
+            try:
+                await self.drain()
+            except OSError:
+                pass  # mất kết nối: run_agent_once tự xử lý qua self.closed
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        super().connection_lost(exc)
+        if not self.authenticated.done():
+            self.authenticated.set_exception(RuntimeError("server closed during auth"))
+        if not self.closed.done():
+            self.closed.set_result(None)
 
-        try:
-            writer.write(_pack_response(rid, payload))
-            await writer.drain()
-        except Exception:
-            break
+
+async def _send_loop(conn: AgentProtocol, stop: asyncio.Event) -> None:
+    """
+    Gửi heartbeat + metrics định kỳ.
+    Ngủ đúng tới deadline gần nhất thay vì poll 100ms; khi 2 interval trùng nhau
+    thì heartbeat + metrics đi chung một lần ghi.
+    """
+    loop = asyncio.get_running_loop()
+    next_hb = loop.time()
+    next_metrics = next_hb
+
+    while not stop.is_set():
+        now = loop.time()
+        frames: List[bytes] = []
+
+        if now >= next_hb:
+            frames.append(_pack_heartbeat())
+            next_hb = now + HEARTBEAT_INTERVAL_S
+
+        if now >= next_metrics:
+            frames.append(await loop.run_in_executor(_PSUTIL_EXECUTOR, _pack_metrics))
+            next_metrics = now + METRICS_INTERVAL_S
+
+        if frames:
+            conn.writelines(frames)
+            await conn.drain()
+
+        await asyncio.sleep(max(0.0, min(next_hb, next_metrics) - loop.time()))
 
 
 async def run_agent_once(cfg: AgentConfig) -> None:
     ssl_ctx = build_ssl_context() if cfg.use_tls else None
-    reader, writer = await asyncio.open_connection(cfg.server_host, cfg.server_port, ssl=ssl_ctx)
+    loop = asyncio.get_running_loop()
+    transport, conn = await loop.create_connection(
+        lambda: AgentProtocol(cfg),
+        cfg.server_host,
+        cfg.server_port,
+        ssl=ssl_ctx,
+    )
 
     try:
-        await _authenticate(reader, writer, cfg)
+        await conn.authenticated
         print(f"[+] Connected & authenticated to {cfg.server_host}:{cfg.server_port} as {cfg.client_id}")
 
         stop = asyncio.Event()
-        send_task = asyncio.create_task(_send_loop(writer, stop), name="send_loop")
-        recv_task = asyncio.create_task(_recv_loop(reader, writer, stop), name="recv_loop")
+        send_task = asyncio.create_task(_send_loop(conn, stop), name="send_loop")
 
-        done, pending = await asyncio.wait(
-            {send_task, recv_task},
+        await asyncio.wait(
+            {send_task, conn.closed},
             return_when=asyncio.FIRST_COMPLETED,
         )
 
         stop.set()
-        for t in pending:
-            t.cancel()
-        await asyncio.gather(*pending, return_exceptions=True)
+        if not send_task.done():
+            send_task.cancel()
+        await asyncio.gather(send_task, return_exceptions=True)
 
-        for t in done:
-            exc = t.exception()
+        if not send_task.cancelled():
+            exc = send_task.exception()
             if exc:
                 raise exc
 
     finally:
-        try:
-            writer.close()
-            await writer.wait_closed()
-        except Exception:
-            pass
+        transport.close()
 
 
 async def run_agent_forever(cfg: AgentConfig) -> None:
@@ -359,6 +442,7 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    install_uvloop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -2,33 +2,238 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import json
+import concurrent.futures
+import functools
+import hmac
+import os
 import socket
 import ssl
+import sys
 import time
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Awaitable, Callable, Dict, Optional, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 from src.shared.protocol import (
     TCP_SERVER_PORT,
     UDP_DISCOVERY_PORT,
+    DISCOVERY_MAGIC,
     DEFAULT_AUTH_TOKEN,
+    HEARTBEAT_PREFIX,
     dumps,
+    dumps_value,
     loads,
     PROTOCOL_VERSION,
+    LineProtocol,
+    install_uvloop,
 )
  
 ResponseCallback = Callable[[str, Optional[str], dict], Awaitable[None]]
 
+SOCKET_BUFFER_SIZE = 256 * 1024
 
-@dataclass
+METRIC_KEYS = ("cpu_percent", "mem_percent", "disk_percent")
+LAST_RESPONSES_MAX = 1024
+
+# Frame trả lời cố định -> serialize một lần; auth_ok chỉ có server_time thay đổi.
+_ERR_EXPECTED_AUTH = dumps({"type": "error", "payload": {"reason": "expected auth"}})
+_ERR_BAD_TOKEN = dumps({"type": "error", "payload": {"reason": "bad token"}})
+_ERR_MISSING_CLIENT_ID = dumps({"type": "error", "payload": {"reason": "missing client_id"}})
+_AUTH_OK_PREFIX = b'{"type":"auth_ok","payload":{"server_time":'
+_AUTH_OK_SUFFIX = b"}}\n"
+
+
+@dataclass(slots=True)
 class ClientState:
     client_id: str
     name: str
     addr: Tuple[str, int]
-    writer: asyncio.StreamWriter
+    conn: "ServerProtocol"
     last_seen: float = field(default_factory=lambda: time.time())
     last_metrics: dict = field(default_factory=dict)
+    # Bản chuẩn hoá của last_metrics cho dashboard, dựng lúc metrics đến (không phải mỗi tick).
+    metrics_row: dict = field(default_factory=lambda: dict.fromkeys(METRIC_KEYS))
+    # "ip:port" không đổi suốt kết nối -> format một lần.
+    addr_str: str = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.addr_str = f"{self.addr[0]}:{self.addr[1]}"
+
+
+class ServerProtocol(LineProtocol):
+    """Một kết nối agent phía server: frame đầu tiên phải là auth, sau đó là metrics/heartbeat/response."""
+
+    def __init__(self, server: "MonitorServer") -> None:
+        super().__init__()
+        self.server = server
+        self.peer: Optional[Tuple[str, int]] = None
+        self.client_id: Optional[str] = None
+        self.client: Optional[ClientState] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._pending_out: List[bytes] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._flushed: Optional[asyncio.Future] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        super().connection_made(transport)
+        self.peer = transport.get_extra_info("peername")
+
+    def handle_message(self, line: bytes) -> None:
+        client = self.client
+        if client is not None and line.startswith(HEARTBEAT_PREFIX):
+            # Fast path: heartbeat chỉ cập nhật last_seen, khỏi loads + dispatch.
+            client.last_seen = time.time()
+            return
+
+        try:
+            msg = loads(line)
+            if self.client is None:
+                self._handle_auth(msg)
+            else:
+                self._handle_frame(msg)
+        except Exception as exc:
+            print(f"[!] Error with client {self.peer}: {exc}")
+            self.transport.close()
+
+    def frame_too_large(self) -> None:
+        print(f"[!] Error with client {self.peer}: frame exceeds {self.MAX_FRAME_SIZE} bytes")
+        super().frame_too_large()
+
+    def _reject(self, frame: bytes) -> None:
+        self.write(frame)
+        self.transport.close()
+
+    def _handle_auth(self, msg: dict) -> None:
+        if msg.get("v") != PROTOCOL_VERSION or msg.get("type") != "auth":
+            self._reject(_ERR_EXPECTED_AUTH)
+            return
+
+        payload = msg.get("payload") or {}
+        token = payload.get("token") or ""
+        if not isinstance(token, str) or not hmac.compare_digest(
+            token.encode("utf-8"), self.server.auth_token_bytes
+        ):
+            self._reject(_ERR_BAD_TOKEN)
+            return
+
+        client_id = payload.get("client_id", "")
+        name = payload.get("name", "unknown")
+
+        if not client_id:
+            self._reject(_ERR_MISSING_CLIENT_ID)
+            return
+
+        self.client_id = client_id
+        # Giữ sẵn tham chiếu ClientState cho cả vòng đời kết nối, khỏi tra dict mỗi frame.
+        self.client = self.server.clients[client_id] = ClientState(
+            client_id=client_id,
+            name=name,
+            addr=self.peer,
+            conn=self,
+        )
+        print(f"[+] Client {client_id} ({name}) connected from {self.peer}")
+
+        self.write(b"%s%r%s" % (_AUTH_OK_PREFIX, time.time(), _AUTH_OK_SUFFIX))
+
+    def _handle_frame(self, msg: dict) -> None:
+        client = self.client
+        client_id = client.client_id
+        server = self.server
+        client.last_seen = time.time()
+
+        msg_type = msg.get("type")
+        payload = msg.get("payload") or {}
+
+        if msg_type == "metrics":
+            # Payload hỏng thì bỏ qua bản cập nhật này, không ngắt kết nối agent.
+            if isinstance(payload, dict):
+                client.last_metrics = payload
+                client.metrics_row = {k: payload.get(k) for k in METRIC_KEYS}
+
+        elif msg_type == "response":
+            request_id = msg.get("request_id")
+            if request_id:
+                last_responses = server.last_responses
+                last_responses[request_id] = {
+                    "client_id": client_id,
+                    "payload": payload,
+                    "t": time.time(),
+                }
+                if len(last_responses) > LAST_RESPONSES_MAX:
+                    last_responses.popitem(last=False)
+
+            if server.on_response:
+                task = asyncio.ensure_future(self._notify(client_id, request_id, payload))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            if server.print_payloads:
+                print(
+                    f"[response] client={client_id} "
+                    f"request_id={request_id} "
+                    f"payload={dumps_value(payload).decode('utf-8')}"
+                )
+            else:
+                print(f"[response] client={client_id} request_id={request_id}")
+
+        elif msg_type == "heartbeat":
+            pass
+
+        else:
+            print(f"[?] Unknown message from {client_id}: {msg}")
+
+    async def _notify(self, client_id: str, request_id: Optional[str], payload: dict) -> None:
+        try:
+            await self.server.on_response(client_id, request_id, payload)
+        except Exception as exc:
+            print(f"[!] on_response callback error: {exc}")
+
+    def queue_request(self, frame: bytes) -> Optional[asyncio.Future]:
+        """
+        Write a request frame to the agent.
+        Frame đầu tiên ghi ngay và mở một "cửa sổ" tới lượt call_soon kế tiếp; các frame đến
+        trong lúc đó (nhiều send_request cùng lúc) được gom vào một lần writelines.
+        Frame bị hoãn -> trả về future, xong khi đã vào transport (lỗi nếu kết nối đã đóng).
+        """
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+        loop = asyncio.get_running_loop()
+        if self._flush_handle is None:
+            self.write(frame)
+            self._flush_handle = loop.call_soon(self._flush_requests)
+            return None
+
+        self._pending_out.append(frame)
+        if self._flushed is None:
+            self._flushed = loop.create_future()
+        return self._flushed
+
+    def _flush_requests(self) -> None:
+        self._flush_handle = None
+        frames, self._pending_out = self._pending_out, []
+        flushed, self._flushed = self._flushed, None
+        if flushed is None or flushed.done():
+            return
+        if self.transport.is_closing():
+            flushed.set_exception(ConnectionResetError("Connection lost"))
+            return
+        self.writelines(frames)
+        flushed.set_result(None)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        super().connection_lost(exc)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending_out.clear()
+        flushed, self._flushed = self._flushed, None
+        if flushed is not None and not flushed.done():
+            flushed.set_exception(ConnectionResetError("Connection lost"))
+        client_id = self.client_id
+        clients = self.server.clients
+        if self.client is not None and clients.get(client_id) is self.client:
+            print(f"[-] Client {client_id} disconnected")
+            clients.pop(client_id, None)
 
 
 class MonitorServer:
@@ -36,20 +241,42 @@ class MonitorServer:
         self.host = host
         self.port = port
         self.auth_token = auth_token
+        self.auth_token_bytes = auth_token.encode("utf-8")
 
         self.clients: Dict[str, ClientState] = {}
-        self.last_responses: Dict[str, dict] = {}
+        # Chỉ giữ LAST_RESPONSES_MAX response gần nhất (cũ nhất bị bỏ trước).
+        self.last_responses: "OrderedDict[str, dict]" = OrderedDict()
 
         self._server: Optional[asyncio.AbstractServer] = None
         self.on_response: Optional[ResponseCallback] = None
+        # CLI cần in payload ra màn hình; dashboard đã đẩy payload qua WebSocket nên tắt đi
+        # để khỏi serialize lại mỗi response (processes/netstat khá lớn).
+        self.print_payloads = True
 
-    async def start(self, ssl_ctx: Optional[ssl.SSLContext] = None) -> None:
-        self._server = await asyncio.start_server(
-            self.handle_client,
-            self.host,
+    async def start(
+        self,
+        ssl_ctx: Optional[ssl.SSLContext] = None,
+        reuse_port: bool = False,
+    ) -> None:
+        if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+
+        loop = asyncio.get_running_loop()
+        # host/port để asyncio bind đủ mọi địa chỉ getaddrinfo trả về (IPv4 + IPv6).
+        self._server = await loop.create_server(
+            lambda: ServerProtocol(self),
+            self.host or None,
             self.port,
             ssl=ssl_ctx,
+            reuse_port=reuse_port or None,
+            start_serving=False,
         )
+        # Buffer phải set trên socket listen trước listen() để window scaling có hiệu lực;
+        # socket accept() kế thừa luôn.
+        for sock in self._server.sockets:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        await self._server.start_serving()
         addrs = ", ".join(str(sock.getsockname()) for sock in self._server.sockets or [])
         print(f"[TCP] Server listening on {addrs}")
 
@@ -58,117 +285,6 @@ class MonitorServer:
         async with self._server:
             await self._server.serve_forever()
 
-    async def handle_client(
-        self,
-        reader: asyncio.StreamReader,
-        writer: asyncio.StreamWriter,
-    ) -> None:
-        peer = writer.get_extra_info("peername")
-        client_id: Optional[str] = None
-
-        try:
-            line = await reader.readline()
-            if not line:
-                writer.close()
-                await writer.wait_closed()
-                return
-
-            msg = loads(line)
-            if msg.get("v") != PROTOCOL_VERSION or msg.get("type") != "auth":
-                writer.write(dumps({"type": "error", "payload": {"reason": "expected auth"}}))
-                await writer.drain()
-                writer.close()
-                await writer.wait_closed()
-                return
-
-            token = msg.get("payload", {}).get("token", "")
-            if token != self.auth_token:
-                writer.write(dumps({"type": "error", "payload": {"reason": "bad token"}}))
-                await writer.drain()
-                writer.close()
-                await writer.wait_closed()
-                return
-
-            payload = msg.get("payload", {})
-            client_id = payload.get("client_id", "")
-            name = payload.get("name", "unknown")
-
-            if not client_id:
-                writer.write(dumps({"type": "error", "payload": {"reason": "missing client_id"}}))
-                await writer.drain()
-                writer.close()
-                await writer.wait_closed()
-                return
-
-            self.clients[client_id] = ClientState(
-                client_id=client_id,
-                name=name,
-                addr=peer,
-                writer=writer,
-            )
-            print(f"[+] Client {client_id} ({name}) connected from {peer}")
-
-            writer.write(dumps({"type": "auth_ok", "payload": {"server_time": time.time()}}))
-            await writer.drain()
-
-            while True:
-                line = await reader.readline()
-                if not line:
-                    break
-
-                msg = loads(line)
-                client = self.clients.get(client_id)
-                if client:
-                    client.last_seen = time.time()
-
-                msg_type = msg.get("type")
-                payload = msg.get("payload", {})
-
-                if msg_type == "metrics":
-                    if client:
-                        client.last_metrics = payload
-
-                elif msg_type == "response":
-                    request_id = msg.get("request_id")
-                    if request_id:
-                        self.last_responses[request_id] = {
-                            "client_id": client_id,
-                            "payload": payload,
-                            "t": time.time(),
-                        }
-
-                    if self.on_response:
-                        try:
-                            await self.on_response(client_id, request_id, payload)
-                        except Exception as exc:
-                            print(f"[!] on_response callback error: {exc}")
-
-                    print(
-                        f"[response] client={client_id} "
-                        f"request_id={request_id} "
-                        f"payload={json.dumps(payload, ensure_ascii=False)}"
-                    )
-
-                elif msg_type == "heartbeat":
-                    pass
-
-                else:
-                    print(f"[?] Unknown message from {client_id}: {msg}")
-
-        except Exception as exc:
-            print(f"[!] Error with client {peer}: {exc}")
-
-        finally:
-            if client_id and client_id in self.clients:
-                print(f"[-] Client {client_id} disconnected")
-                self.clients.pop(client_id, None)
-
-            writer.close()
-            try:
-                await writer.wait_closed()
-            except Exception:
-                pass
-
     async def send_request(
         self,
         client_id: str,
@@ -186,8 +302,12 @@ class MonitorServer:
             "request_id": request_id,
             "payload": {"req_type": req_type, "data": payload},
         }
-        client.writer.write(dumps(msg))
-        await client.writer.drain()
+        conn = client.conn
+        flushed = conn.queue_request(dumps(msg))
+        if flushed is not None:
+            # shield: huỷ một send_request không được huỷ future chung của cả lô.
+            await asyncio.shield(flushed)
+        await conn.drain()
 
     def list_clients(self):
         now = time.time()
@@ -199,7 +319,7 @@ class MonitorServer:
                 (
                     cid,
                     client.name,
-                    f"{client.addr[0]}:{client.addr[1]}",
+                    client.addr_str,
                     f"{age:0.1f}s",
                     client.last_metrics,
                 )
@@ -207,6 +327,21 @@ class MonitorServer:
         return rows
 
 
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """Trả lời gói UDP discovery ngay trên event loop (không cần thread executor)."""
+
+    def __init__(self, tcp_port: int) -> None:
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self._reply = dumps_value({"tcp_port": tcp_port})
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if data.strip() == DISCOVERY_MAGIC:
+            self.transport.sendto(self._reply, addr)
+
+
 async def udp_discovery_responder(
     bind_ip: str,
     port: int,
@@ -220,11 +355,14 @@ async def udp_discovery_responder(
     print(f"[UDP] Discovery responder on {bind_ip}:{port}")
     loop = asyncio.get_running_loop()
 
-    while True:
-        data, addr = await loop.run_in_executor(None, sock.recvfrom, 2048)
-        if data.strip() == b"DISCOVER_PC_MONITOR":
-            reply = json.dumps({"tcp_port": tcp_port}).encode("utf-8")
-            sock.sendto(reply, addr)
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DiscoveryProtocol(tcp_port),
+        sock=sock,
+    )
+    try:
+        await loop.create_future()
+    finally:
+        transport.close()
 
 
 def build_ssl_context(certfile: str, keyfile: str) -> ssl.SSLContext:
@@ -233,6 +371,78 @@ def build_ssl_context(certfile: str, keyfile: str) -> ssl.SSLContext:
     return ctx
 
 
+class StdinReader:
+    """
+    Đọc lệnh từ stdin theo dòng.
+    POSIX: loop.add_reader + asyncio.Queue, không chiếm thread nào của executor.
+    Windows (không add_reader được stdin): fallback về input() trên một thread riêng,
+    để không giữ mãi 1 slot của default executor.
+    """
+
+    PROMPT = "monitor> "
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._buf = bytearray()
+        self._input = functools.partial(input, self.PROMPT)
+        self._fd: Optional[int] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+        if sys.platform != "win32":
+            try:
+                fd = sys.stdin.fileno()
+                loop.add_reader(fd, self._on_readable)
+                self._fd = fd
+            except (NotImplementedError, OSError, ValueError):
+                self._fd = None
+
+        if self._fd is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="cli",
+            )
+
+    def _on_readable(self) -> None:
+        data = os.read(self._fd, 4096)
+        if not data:
+            self._loop.remove_reader(self._fd)
+            if self._buf:
+                self._queue.put_nowait(self._buf.decode("utf-8", "replace"))
+                self._buf.clear()
+            self._queue.put_nowait(None)
+            return
+
+        buf = self._buf
+        buf += data
+        while True:
+            idx = buf.find(b"\n")
+            if idx < 0:
+                break
+            self._queue.put_nowait(buf[:idx].decode("utf-8", "replace"))
+            del buf[: idx + 1]
+
+    async def readline(self) -> Optional[str]:
+        """Return the next line (without newline), or None on EOF."""
+        if self._executor is not None:
+            try:
+                return await self._loop.run_in_executor(self._executor, self._input)
+            except EOFError:
+                return None
+
+        print(self.PROMPT, end="", flush=True)
+        return await self._queue.get()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+        if self._executor is not None:
+            # Không chờ: nếu input() còn đang chặn thì thread tự kết thúc khi stdin có dòng/EOF.
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
 async def interactive_cli(server: MonitorServer) -> None:
     """Simple interactive CLI for demo."""
     print("\nCommands:")
@@ -243,11 +453,23 @@ async def interactive_cli(server: MonitorServer) -> None:
     print("  help                          - show commands")
     print("  quit                          - exit\n")
 
+    stdin = StdinReader(asyncio.get_running_loop())
+
+    try:
+        await _cli_loop(server, stdin)
+    finally:
+        stdin.close()
+
+
+async def _cli_loop(server: MonitorServer, stdin: StdinReader) -> None:
     counter = 0
-    loop = asyncio.get_running_loop()
 
     while True:
-        cmd = await loop.run_in_executor(None, lambda: input("monitor> ").strip())
+        line = await stdin.readline()
+        if line is None:
+            break
+
+        cmd = line.strip()
         if not cmd:
             continue
 
@@ -303,12 +525,20 @@ async def main() -> None:
     parser.add_argument("--tls", action="store_true", help="Enable TLS")
     parser.add_argument("--certfile", default="certs/server.crt")
     parser.add_argument("--keyfile", default="certs/server.key")
+    parser.add_argument(
+        "--reuse-port",
+        action="store_true",
+        help="Set SO_REUSEPORT so several server processes can share the TCP port (POSIX).",
+    )
     args = parser.parse_args()
 
     ssl_ctx = build_ssl_context(args.certfile, args.keyfile) if args.tls else None
 
     server = MonitorServer(args.host, args.port, args.auth_token)
-    await server.start(ssl_ctx=ssl_ctx)
+    try:
+        await server.start(ssl_ctx=ssl_ctx, reuse_port=args.reuse_port)
+    except ValueError as exc:
+        parser.error(str(exc))
 
     await asyncio.gather(
         udp_discovery_responder(args.udp_bind, args.udp_port, args.port),
@@ -317,6 +547,7 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    install_uvloop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -2,21 +2,38 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import json
+import gzip
+import hashlib
+import itertools
 import time
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List
 
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 
 from src.server.server import MonitorServer, udp_discovery_responder
-from src.shared.protocol import TCP_SERVER_PORT, UDP_DISCOVERY_PORT, DEFAULT_AUTH_TOKEN
+from src.shared.protocol import (
+    TCP_SERVER_PORT,
+    UDP_DISCOVERY_PORT,
+    DEFAULT_AUTH_TOKEN,
+    dumps_value,
+    install_uvloop,
+)
 
 app = FastAPI(title="PC Network Monitor")
 
 SERVER: MonitorServer | None = None
-WS_CLIENTS: Set[WebSocket] = set()
+WS_CLIENTS: Dict[WebSocket, asyncio.Queue] = {}
+WS_SEND_QUEUE_MAX = 64
+
+_REQUEST_IDS = itertools.count(1)
+
+SNAPSHOT_KEYFRAME_TICKS = 30
+
+# Rows của tick gần nhất (broadcast_snapshots); frame snapshot được encode lười, tối đa 1 lần/tick.
+_LAST_SNAPSHOT_ROWS: List[Dict[str, Any]] | None = None
+_LAST_SNAPSHOT_FRAME = b""
 
 
 def snapshot_clients() -> List[Dict[str, Any]]:
@@ -28,18 +45,13 @@ def snapshot_clients() -> List[Dict[str, Any]]:
     items: List[Dict[str, Any]] = []
     for cid, c in SERVER.clients.items():
         age = max(0.0, now - float(c.last_seen))
-        m = c.last_metrics or {}
         items.append(
             {
                 "client_id": cid,
                 "name": c.name,
-                "addr": f"{c.addr[0]}:{c.addr[1]}",
+                "addr": c.addr_str,
                 "last_seen_sec": round(age, 2),
-                "metrics": {
-                    "cpu_percent": m.get("cpu_percent"),
-                    "mem_percent": m.get("mem_percent"),
-                    "disk_percent": m.get("disk_percent"),
-                },
+                "metrics": c.metrics_row,
             }
         )
 
@@ -47,22 +59,89 @@ def snapshot_clients() -> List[Dict[str, Any]]:
     return items
 
 
-async def ws_broadcast(message: Dict[str, Any]) -> None:
+def encode_ws(message: Dict[str, Any]) -> bytes:
+    """
+    Serialize a UI message once so it can be fanned out to every websocket.
+    Gửi dạng binary frame (UTF-8 JSON) để không phải encode str -> bytes lại cho từng ws.
+    """
+    return dumps_value(message)
+
+
+def ws_broadcast(message: Dict[str, Any]) -> None:
     """Broadcast JSON message to all websocket clients."""
     if not WS_CLIENTS:
         return
+    ws_broadcast_frame(encode_ws(message))
+
+
+def ws_broadcast_frame(frame: bytes) -> None:
+    """
+    Queue an already-encoded frame for every websocket (không await).
+    Mỗi ws có queue giới hạn + task ghi riêng; ws chậm bị đầy queue thì bỏ frame cũ nhất.
+    """
+    for queue in WS_CLIENTS.values():
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(frame)
 
-    payload = json.dumps(message, ensure_ascii=False)
-    dead: List[WebSocket] = []
 
-    for ws in WS_CLIENTS:
+def _encode_items(items: List[Any], what: str) -> List[bytes]:
+    """
+    Encode từng phần tử riêng để ghép vào frame.
+    Dữ liệu do agent gửi có thể không encode được (vd. lồng quá sâu) -> in lỗi và chỉ bỏ phần tử đó.
+    """
+    out: List[bytes] = []
+    for item in items:
         try:
-            await ws.send_text(payload)
-        except Exception:
-            dead.append(ws)
+            out.append(dumps_value(item))
+        except Exception as exc:
+            print(f"[!] Dropping {what} that cannot be encoded: {exc}")
+    return out
+
+
+_BATCH_HEAD = b'{"type":"batch","items":['
+_BATCH_TAIL = b"]}"
+_SNAPSHOT_HEAD = b'{"type":"snapshot","payload":{"clients":['
+_SNAPSHOT_TAIL = b"]}}"
+_DELTA_HEAD = b'{"type":"delta","payload":{"upsert":['
+_DELTA_SEEN = b'],"seen":'
+_DELTA_TAIL = b"}}"
 
-    for ws in dead:
-        WS_CLIENTS.discard(ws)
+
+def _snapshot_bytes(rows: List[Dict[str, Any]]) -> bytes:
+    return _SNAPSHOT_HEAD + b",".join(_encode_items(rows, "client row")) + _SNAPSHOT_TAIL
+
+
+def snapshot_frame() -> bytes:
+    """
+    Full snapshot frame for a newly opened websocket.
+    Reuses the rows of the last broadcast tick so the following delta applies cleanly;
+    before the first tick (or while no websocket is open) it is built on demand.
+    """
+    global _LAST_SNAPSHOT_FRAME
+    if _LAST_SNAPSHOT_ROWS is None:
+        return _snapshot_bytes(snapshot_clients())
+    if not _LAST_SNAPSHOT_FRAME:
+        _LAST_SNAPSHOT_FRAME = _snapshot_bytes(_LAST_SNAPSHOT_ROWS)
+    return _LAST_SNAPSHOT_FRAME
+
+
+async def _ws_writer(websocket: WebSocket, queue: asyncio.Queue) -> None:
+    """
+    Drain one websocket's send queue; a failed send unregisters the socket.
+    Frame nào dồn lại trong lúc chờ send thì gộp vào một frame "batch" (ghép bytes, không encode lại).
+    """
+    try:
+        while True:
+            frame = await queue.get()
+            if not queue.empty():
+                frames = [frame]
+                while not queue.empty():
+                    frames.append(queue.get_nowait())
+                frame = _BATCH_HEAD + b",".join(frames) + _BATCH_TAIL
+            await websocket.send_bytes(frame)
+    except Exception:
+        WS_CLIENTS.pop(websocket, None)
 
 
 INDEX_HTML = r"""<!doctype html>
@@ -393,12 +472,21 @@ INDEX_HTML = r"""<!doctype html>
 <script>
   let selectedClientId = "";
   let ws = null;
+  const utf8 = new TextDecoder();
 
   let lastSnapshot = [];
+  let clientsById = new Map();
+  // client_id -> {tr, c, ...refs tới các ô}; xem buildRow/patchRow.
+  const rowCache = new Map();
   const lastByTab = { sysinfo: null, processes: null, netstat: null };
   let activeRaw = null;
 
-  const el = (id) => document.getElementById(id);
+  // Các phần tử cố định của trang: tra getElementById một lần lúc load thay vì mỗi lần render.
+  const E = Object.freeze(Object.fromEntries(
+    ["tbody", "count", "q", "sort", "wsDot", "wsState", "log", "selected",
+     "sysPane", "procPane", "netPane", "tSys", "tProc", "tNet"]
+      .map(id => [id, document.getElementById(id)])
+  ));
   const clamp = (n, a, b) => Math.max(a, Math.min(b, n));
 
   function pct(v){
@@ -419,25 +507,36 @@ INDEX_HTML = r"""<!doctype html>
   }
 
   function setWsState(text, ok){
-    el("wsState").textContent = text;
-    const d = el("wsDot");
+    E.wsState.textContent = text;
+    const d = E.wsDot;
     d.className = ok ? "dot ok" : "dot";
   }
 
   function setSelected(cid){
+    const prevRow = rowCache.get(selectedClientId);
     selectedClientId = cid || "";
-    el("selected").textContent = selectedClientId || "(none)";
-    renderClients();
+    E.selected.textContent = selectedClientId || "(none)";
+
+    // Chỉ đổi class của 2 hàng liên quan, không render lại cả bảng.
+    if (prevRow){
+      prevRow.active = false;
+      prevRow.tr.classList.toggle("active", false);
+    }
+    const row = rowCache.get(selectedClientId);
+    if (row){
+      row.active = true;
+      row.tr.classList.toggle("active", true);
+    }
   }
 
   function clearAll(){
-    el("log").textContent = "";
-    el("sysPane").textContent = "No data.";
-    el("sysPane").className = "empty";
-    el("procPane").textContent = "No data.";
-    el("procPane").className = "empty";
-    el("netPane").textContent = "No data.";
-    el("netPane").className = "empty";
+    E.log.textContent = "";
+    E.sysPane.textContent = "No data.";
+    E.sysPane.className = "empty";
+    E.procPane.textContent = "No data.";
+    E.procPane.className = "empty";
+    E.netPane.textContent = "No data.";
+    E.netPane.className = "empty";
     activeRaw = null;
     lastByTab.sysinfo = null;
     lastByTab.processes = null;
@@ -445,7 +544,7 @@ INDEX_HTML = r"""<!doctype html>
   }
 
   function appendLog(line){
-    const pre = el("log");
+    const pre = E.log;
     pre.textContent += line + "\n";
     pre.scrollTop = pre.scrollHeight;
   }
@@ -455,11 +554,11 @@ INDEX_HTML = r"""<!doctype html>
     document.querySelectorAll(".pane").forEach(p => p.classList.remove("active"));
 
     document.querySelector(`.tab[data-tab="${tabId}"]`).classList.add("active");
-    el(tabId).classList.add("active");
+    E[tabId]?.classList.add("active");
 
     // Raw tab shows latest response JSON
     if (tabId === "tRaw"){
-      const pre = el("log");
+      const pre = E.log;
       if (activeRaw) pre.textContent = JSON.stringify(activeRaw, null, 2) + "\n";
     }
   }
@@ -473,7 +572,7 @@ INDEX_HTML = r"""<!doctype html>
   }
 
   function renderKV(targetId, obj){
-    const host = el(targetId);
+    const host = E[targetId];
     if (!obj){
       host.textContent = "No data.";
       host.className = "empty";
@@ -494,7 +593,7 @@ INDEX_HTML = r"""<!doctype html>
   }
 
   function renderJSON(targetId, obj){
-    const host = el(targetId);
+    const host = E[targetId];
     if (!obj){
       host.textContent = "No data.";
       host.className = "empty";
@@ -517,9 +616,20 @@ INDEX_HTML = r"""<!doctype html>
     return hay.includes(q);
   }
 
+  // Gom mọi yêu cầu render (delta, batch, search, sort) vào tối đa một lần mỗi animation frame.
+  let renderPending = false;
+  function scheduleRender(){
+    if (renderPending) return;
+    renderPending = true;
+    requestAnimationFrame(() => {
+      renderPending = false;
+      renderClients();
+    });
+  }
+
   function renderClients(){
-    const q = (el("q").value || "").trim().toLowerCase();
-    const sortKey = el("sort").value;
+    const q = (E.q.value || "").trim().toLowerCase();
+    const sortKey = E.sort.value;
 
     let list = (lastSnapshot || []).filter(c => passesQuery(c, q));
 
@@ -537,50 +647,110 @@ INDEX_HTML = r"""<!doctype html>
       return 0;
     });
 
-    el("count").textContent = String(list.length);
-
-    const tbody = el("tbody");
-    tbody.innerHTML = "";
+    E.count.textContent = String(list.length);
 
+    // Tái sử dụng <tr> theo client_id: chỉ sửa ô đổi và dời node về đúng thứ tự, không dựng lại cả bảng.
+    const tbody = E.tbody;
+    const shown = new Set();
+    let prev = null;
     for (const c of list){
-      const tr = document.createElement("tr");
-      if (c.client_id === selectedClientId) tr.classList.add("active");
-      tr.onclick = () => setSelected(c.client_id);
+      let row = rowCache.get(c.client_id);
+      if (!row){
+        row = buildRow(c.client_id);
+        rowCache.set(c.client_id, row);
+      }
+      patchRow(row, c);
+      shown.add(c.client_id);
 
-      const seen = Number(c.last_seen_sec ?? 9999);
-      const st = statusFromSeen(seen);
+      const want = prev ? prev.nextSibling : tbody.firstChild;
+      if (row.tr !== want) tbody.insertBefore(row.tr, want);
+      prev = row.tr;
+    }
+
+    for (const [cid, row] of rowCache){
+      if (shown.has(cid)) continue;
+      row.tr.remove();
+      if (!clientsById.has(cid)) rowCache.delete(cid);
+    }
+  }
+
+  function buildRow(cid){
+    const tr = document.createElement("tr");
+    tr.onclick = () => setSelected(cid);
+    tr.innerHTML = `
+      <td>
+        <div style="display:flex; flex-direction:column; gap:4px;">
+          <div class="row1">
+            <span class="statusDot"></span>
+            <span class="mono cid"></span>
+          </div>
+          <div class="name"></div>
+        </div>
+      </td>
+      <td class="mono addr"></td>
+      <td class="mono seen"></td>
+      <td>
+        <div style="display:grid; grid-template-columns: 54px 1fr; gap:6px 10px; align-items:center;">
+          <div class="muted mono">CPU</div>
+          <div class="bar"><i class="cpu" style="width:0%"></i></div>
+          <div class="muted mono">MEM</div>
+          <div class="bar mem"><i class="mem" style="width:0%"></i></div>
+          <div class="muted mono">DISK</div>
+          <div class="bar disk"><i class="disk" style="width:0%"></i></div>
+        </div>
+        <div class="muted mono usage" style="margin-top:6px;"></div>
+      </td>
+    `;
+    tr.querySelector(".cid").textContent = cid;
+    return {
+      tr,
+      c: null,
+      active: false,
+      seenText: "",
+      dotCls: "",
+      dot: tr.querySelector(".statusDot"),
+      name: tr.querySelector(".name"),
+      addr: tr.querySelector(".addr"),
+      seen: tr.querySelector(".seen"),
+      cpu: tr.querySelector("i.cpu"),
+      mem: tr.querySelector("i.mem"),
+      disk: tr.querySelector("i.disk"),
+      usage: tr.querySelector(".usage"),
+    };
+  }
+
+  function patchRow(row, c){
+    // upsert/snapshot thay object mới -> cập nhật phần tĩnh; delta chỉ sửa last_seen_sec tại chỗ.
+    if (row.c !== c){
+      row.c = c;
+      row.name.textContent = c.name || "";
+      row.addr.textContent = c.addr || "";
 
       const cpu = pct(c.metrics?.cpu_percent);
       const mem = pct(c.metrics?.mem_percent);
       const disk = pct(c.metrics?.disk_percent);
+      row.cpu.style.width = `${cpu===null?0:cpu}%`;
+      row.mem.style.width = `${mem===null?0:mem}%`;
+      row.disk.style.width = `${disk===null?0:disk}%`;
+      row.usage.textContent = `${fmt(cpu)} · ${fmt(mem)} · ${fmt(disk)}`;
+    }
 
-      tr.innerHTML = `
-        <td>
-          <div style="display:flex; flex-direction:column; gap:4px;">
-            <div class="row1">
-              <span class="statusDot ${st.cls}"></span>
-              <span class="mono">${c.client_id}</span>
-            </div>
-            <div class="name">${c.name || ""}</div>
-          </div>
-        </td>
-        <td class="mono">${c.addr || ""}</td>
-        <td class="mono">${seen.toFixed(2)}s</td>
-        <td>
-          <div style="display:grid; grid-template-columns: 54px 1fr; gap:6px 10px; align-items:center;">
-            <div class="muted mono">CPU</div>
-            <div class="bar"><i style="width:${cpu===null?0:cpu}%"></i></div>
-            <div class="muted mono">MEM</div>
-            <div class="bar mem"><i style="width:${mem===null?0:mem}%"></i></div>
-            <div class="muted mono">DISK</div>
-            <div class="bar disk"><i style="width:${disk===null?0:disk}%"></i></div>
-          </div>
-          <div class="muted mono" style="margin-top:6px;">
-            ${fmt(cpu)} · ${fmt(mem)} · ${fmt(disk)}
-          </div>
-        </td>
-      `;
-      tbody.appendChild(tr);
+    const seen = Number(c.last_seen_sec ?? 9999);
+    const seenText = seen.toFixed(2) + "s";
+    if (row.seenText !== seenText){
+      row.seenText = seenText;
+      row.seen.textContent = seenText;
+    }
+    const dotCls = "statusDot " + statusFromSeen(seen).cls;
+    if (row.dotCls !== dotCls){
+      row.dotCls = dotCls;
+      row.dot.className = dotCls;
+    }
+
+    const active = c.client_id === selectedClientId;
+    if (row.active !== active){
+      row.active = active;
+      row.tr.classList.toggle("active", active);
     }
   }
 
@@ -633,6 +803,7 @@ INDEX_HTML = r"""<!doctype html>
   function connectWS(){
     const proto = (location.protocol === "https:") ? "wss" : "ws";
     ws = new WebSocket(`${proto}://${location.host}/ws`);
+    ws.binaryType = "arraybuffer";
 
     ws.onopen = () => setWsState("Connected", true);
 
@@ -641,22 +812,45 @@ INDEX_HTML = r"""<!doctype html>
       setTimeout(connectWS, 900);
     };
 
-    ws.onmessage = (ev) => {
-      const msg = JSON.parse(ev.data);
+    ws.onmessage = (ev) => handleMessage(JSON.parse(
+      typeof ev.data === "string" ? ev.data : utf8.decode(ev.data)
+    ));
+  }
 
-      if (msg.type === "snapshot"){
-        lastSnapshot = msg.payload.clients || [];
-        renderClients();
-      } else if (msg.type === "response"){
-        const p = msg.payload || {};
-        appendLog(`[response] ${p.client_id} (${p.request_id})`);
-        onResponse(p);
-      }
-    };
+  function applyDelta(d){
+    for (const c of (d.upsert || [])) clientsById.set(c.client_id, c);
+    const seen = d.seen || {};
+    for (const [cid, c] of clientsById){
+      if (!(cid in seen)) clientsById.delete(cid);
+      else c.last_seen_sec = seen[cid];
+    }
+    lastSnapshot = Array.from(clientsById.values());
+    scheduleRender();
+  }
+
+  function handleMessage(msg){
+    if (msg.type === "snapshot"){
+      clientsById = new Map((msg.payload.clients || []).map(c => [c.client_id, c]));
+      lastSnapshot = Array.from(clientsById.values());
+      scheduleRender();
+    } else if (msg.type === "delta"){
+      applyDelta(msg.payload || {});
+    } else if (msg.type === "response"){
+      const p = msg.payload || {};
+      appendLog(`[response] ${p.client_id} (${p.request_id})`);
+      onResponse(p);
+    } else if (msg.type === "batch"){
+      for (const item of (msg.items || [])) handleMessage(item);
+    }
   }
 
-  el("q").addEventListener("input", () => renderClients());
-  el("sort").addEventListener("change", () => renderClients());
+  // Gõ tìm kiếm liên tục chỉ render một lần sau khi ngừng gõ ~60ms.
+  let searchTimer = 0;
+  E.q.addEventListener("input", () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(scheduleRender, 60);
+  });
+  E.sort.addEventListener("change", scheduleRender);
 
   connectWS();
 </script>
@@ -666,14 +860,37 @@ INDEX_HTML = r"""<!doctype html>
 
 
 
+def _minify_html(html: str) -> str:
+    """
+    Bỏ thụt lề và dòng trống của trang (không cần thư viện minify).
+    Giữ nguyên xuống dòng để JS không phụ thuộc ASI bị đổi nghĩa; trang không có <pre> nào chứa sẵn text.
+    """
+    return "\n".join(line.strip() for line in html.splitlines() if line.strip())
+
+
+# Trang dashboard là tĩnh -> minify, encode, gzip và tính ETag một lần lúc import.
+_INDEX_BYTES = _minify_html(INDEX_HTML).encode("utf-8")
+_INDEX_GZIP = gzip.compress(_INDEX_BYTES, 6)
+# ETag yếu: bản gzip và bản thường có cùng nội dung nhưng khác byte.
+_INDEX_ETAG = 'W/"' + hashlib.md5(_INDEX_BYTES).hexdigest() + '"'
+_INDEX_HEADERS = {"ETag": _INDEX_ETAG, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+_INDEX_GZIP_HEADERS = {**_INDEX_HEADERS, "Content-Encoding": "gzip"}
+
+
 @app.get("/", response_class=HTMLResponse)
-async def index():
-    return INDEX_HTML
+async def index(request: Request):
+    if _INDEX_ETAG in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=_INDEX_HEADERS)
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(content=_INDEX_GZIP, media_type="text/html; charset=utf-8", headers=_INDEX_GZIP_HEADERS)
+    return Response(content=_INDEX_BYTES, media_type="text/html; charset=utf-8", headers=_INDEX_HEADERS)
 
 
 @app.get("/api/clients")
 async def api_clients():
-    return JSONResponse(snapshot_clients())
+    # orjson bytes thẳng vào Response, khỏi qua json.dumps của JSONResponse.
+    return Response(dumps_value(snapshot_clients()), media_type="application/json")
 
 
 @app.post("/api/request")
@@ -695,42 +912,96 @@ async def api_request(body: Dict[str, Any]):
     if client_id not in SERVER.clients:
         return JSONResponse({"detail": "client not connected"}, status_code=404)
 
-    api_request.counter += 1
-    request_id = f"w{api_request.counter}"
+    request_id = f"w{next(_REQUEST_IDS)}"
 
     await SERVER.send_request(client_id, req_type, request_id, {})
     return {"request_id": request_id}
 
 
-api_request.counter = 0  
-
-
 @app.websocket("/ws")
 async def ws_endpoint(websocket: WebSocket):
     await websocket.accept()
-    WS_CLIENTS.add(websocket)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_MAX)
+    queue.put_nowait(snapshot_frame())
+    WS_CLIENTS[websocket] = queue
+    writer = asyncio.create_task(_ws_writer(websocket, queue))
     try:
-        await websocket.send_text(
-            json.dumps({"type": "snapshot", "payload": {"clients": snapshot_clients()}}, ensure_ascii=False)
-        )
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
         pass
     finally:
-        WS_CLIENTS.discard(websocket)
+        WS_CLIENTS.pop(websocket, None)
+        writer.cancel()
 
 
 async def broadcast_snapshots():
-    """Push live snapshot to UI periodically."""
+    """
+    Push live updates to UI periodically as a delta against the previous tick:
+      upsert: rows whose name/addr/metrics changed (or new clients)
+      seen:   {client_id: last_seen_sec} for every connected client; ids not in
+              here are dropped by the UI, so no separate "removed" list is needed.
+    A newly opened websocket gets a full snapshot of this tick's rows first (snapshot_frame).
+    Every SNAPSHOT_KEYFRAME_TICKS ticks a full snapshot is sent instead, so a websocket whose
+    queue overflowed (oldest frame dropped, maybe an upsert) resyncs within that window.
+    """
+    global _LAST_SNAPSHOT_ROWS, _LAST_SNAPSHOT_FRAME
+    last_keys: Dict[str, tuple] = {}
+    last_frame = b""
+    tick = 0
     while True:
         await asyncio.sleep(1.0)
-        await ws_broadcast({"type": "snapshot", "payload": {"clients": snapshot_clients()}})
+        tick += 1
+        if not WS_CLIENTS:
+            last_keys = {}
+            last_frame = b""
+            _LAST_SNAPSHOT_ROWS = None
+            _LAST_SNAPSHOT_FRAME = b""
+            continue
+
+        try:
+            keys: Dict[str, tuple] = {}
+            upsert: List[Dict[str, Any]] = []
+            seen: Dict[str, float] = {}
+            rows = snapshot_clients()
+            _LAST_SNAPSHOT_ROWS = rows
+            _LAST_SNAPSHOT_FRAME = b""
+            for row in rows:
+                cid = row["client_id"]
+                # metrics là ClientState.metrics_row (dict thay mới mỗi lần metrics đến), giữ tham chiếu
+                # thay vì dựng tuple giá trị; so sánh tuple sẽ thử `is` trước nên row không đổi rất rẻ.
+                key = (row["name"], row["addr"], row["metrics"])
+                keys[cid] = key
+                seen[cid] = row["last_seen_sec"]
+                if last_keys.get(cid) != key:
+                    upsert.append(row)
+            last_keys = keys
+
+            if tick % SNAPSHOT_KEYFRAME_TICKS == 0:
+                frame = snapshot_frame()
+            else:
+                # metrics_row chứa giá trị agent gửi -> encode từng row, row hỏng bị bỏ chứ không mất cả tick.
+                frame = (
+                    _DELTA_HEAD
+                    + b",".join(_encode_items(upsert, "client row"))
+                    + _DELTA_SEEN
+                    + dumps_value(seen)
+                    + _DELTA_TAIL
+                )
+            if frame == last_frame:
+                continue
+            last_frame = frame
+            ws_broadcast_frame(frame)
+        except Exception as exc:
+            print(f"[!] broadcast_snapshots error: {exc}")
 
 
 async def broadcast_response(client_id: str, request_id: str | None, payload: Dict[str, Any]):
-    """Callback from MonitorServer -> push response to UI."""
-    await ws_broadcast(
+    """
+    Callback from MonitorServer -> push response to UI.
+    Response dồn lại ở ws chậm được _ws_writer gộp thành frame "batch"; lỗi encode do _notify in ra.
+    """
+    ws_broadcast(
         {
             "type": "response",
             "payload": {"client_id": client_id, "request_id": request_id, "payload": payload},
@@ -753,10 +1024,20 @@ async def main():
 
     SERVER = MonitorServer(args.host, args.port, args.auth_token)
     SERVER.on_response = broadcast_response
+    SERVER.print_payloads = False
 
     await SERVER.start(ssl_ctx=None)
 
-    config = uvicorn.Config(app, host=args.web_host, port=args.web_port, log_level="info")
+    # Loop đã là uvloop nếu có (install_uvloop() trước asyncio.run); serve() không tự đổi loop.
+    config = uvicorn.Config(
+        app,
+        host=args.web_host,
+        port=args.web_port,
+        log_level="info",
+        http="httptools",
+        ws="websockets",
+        access_log=False,
+    )
     uv_server = uvicorn.Server(config)
 
     await asyncio.gather(
@@ -767,6 +1048,7 @@ async def main():
 
 
 if __name__ == "__main__":
+    install_uvloop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
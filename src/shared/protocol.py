@@ -7,26 +7,50 @@ Security note: This project is intended for **explicitly authorized** monitoring
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import secrets
+import socket
+import sys
+from collections import deque
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 PROTOCOL_VERSION = "1.0"
 
 UDP_DISCOVERY_PORT = 9999
+DISCOVERY_MAGIC = b"DISCOVER_PC_MONITOR"
 TCP_SERVER_PORT = 9009
 
 DEFAULT_AUTH_TOKEN = "NHOM8-DEMO-TOKEN"
 
+# Agent dựng heartbeat từ đúng prefix này -> server nhận diện heartbeat mà không cần parse JSON.
+HEARTBEAT_PREFIX = b'{"v":' + json.dumps(PROTOCOL_VERSION).encode("utf-8") + b',"type":"heartbeat","payload":{"t":'
+
 
 def dumps(obj: Dict[str, Any]) -> bytes:
     """Encode a message to NDJSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
     return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
 
 
+def dumps_value(obj: Any) -> bytes:
+    """Encode a JSON value without the frame newline (for splicing into templates)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
 def loads(line: bytes) -> Dict[str, Any]:
     """Decode a NDJSON line to dict."""
+    if orjson is not None:
+        return orjson.loads(line)
     return json.loads(line.decode("utf-8"))
 
 
@@ -34,6 +58,18 @@ def new_client_id() -> str:
     return secrets.token_urlsafe(8)
 
 
+def install_uvloop() -> bool:
+    """Use uvloop's event loop policy on POSIX when it is installed (optional)."""
+    if sys.platform == "win32":
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
 @dataclass
 class Message:
     """Helper wrapper (optional)."""
@@ -51,3 +87,116 @@ class Message:
         if self.request_id is not None:
             d["request_id"] = self.request_id
         return d
+
+
+class LineProtocol(asyncio.Protocol):
+    """NDJSON framing directly on top of an asyncio transport.
+
+    Incoming bytes are split on '\n' inside data_received(); only a trailing
+    partial frame is kept in a bytearray. Each complete frame goes to
+    handle_message() without the StreamReader/readline coroutine round-trip.
+    Subclasses override handle_message().
+
+    Backpressure: the transport buffer is capped at WRITE_BUFFER_HIGH; while it is
+    over the limit, drain() blocks, so writers that await it cannot queue frames
+    without bound. Reading is never paused (both sides backing up would deadlock).
+    """
+
+    WRITE_BUFFER_HIGH = 64 * 1024
+    WRITE_BUFFER_LOW = 8 * 1024
+    # Giống limit mặc định của StreamReader.readline(): frame dài hơn -> đóng kết nối.
+    MAX_FRAME_SIZE = 64 * 1024
+
+    def __init__(self) -> None:
+        self.transport: Optional[asyncio.Transport] = None
+        self._buf = bytearray()
+        self._paused = False
+        # Nhiều coroutine có thể cùng chờ drain() (vd. nhiều send_request song song) -> giữ hết.
+        self._drain_waiters: "deque[asyncio.Future]" = deque()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+        transport.set_write_buffer_limits(high=self.WRITE_BUFFER_HIGH, low=self.WRITE_BUFFER_LOW)
+        # Frame nhỏ (heartbeat/metrics/request) -> tắt Nagle để không bị trễ ~40ms.
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def data_received(self, data: bytes) -> None:
+        buf = self._buf
+        # Thường mỗi segment chứa trọn các frame -> cắt thẳng trên `data`,
+        # chỉ copy vào buffer khi còn phần dở dang.
+        if buf:
+            buf += data
+            chunk = buf
+        else:
+            chunk = data
+
+        limit = self.MAX_FRAME_SIZE
+        start = 0
+        while not self.transport.is_closing():
+            idx = chunk.find(b"\n", start)
+            if idx < 0:
+                break
+            if idx - start > limit:
+                self.frame_too_large()
+                return
+            line = chunk[start:idx]
+            start = idx + 1
+            self.handle_message(line)
+
+        if len(chunk) - start > limit:
+            self.frame_too_large()
+            return
+
+        if chunk is buf:
+            if start:
+                del buf[:start]
+        elif start < len(chunk):
+            buf += memoryview(chunk)[start:]
+
+    def handle_message(self, line: bytes) -> None:
+        raise NotImplementedError
+
+    def frame_too_large(self) -> None:
+        self._buf.clear()
+        self.transport.close()
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    def writelines(self, frames: List[bytes]) -> None:
+        """Queue several frames in one transport call (one send() when the buffer is empty)."""
+        self.transport.writelines(frames)
+
+    async def drain(self) -> None:
+        """Wait until the transport's write buffer is below the high-water mark."""
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+        if not self._paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self._drain_waiters.remove(waiter)
+
+    def pause_writing(self) -> None:
+        self._paused = True
+
+    def resume_writing(self) -> None:
+        self._paused = False
+        self._wake_drain(None)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._wake_drain(exc or ConnectionResetError("Connection lost"))
+
+    def _wake_drain(self, exc: Optional[Exception]) -> None:
+        for waiter in self._drain_waiters:
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)